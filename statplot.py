@@ -1,9 +1,49 @@
+import math
+from functools import lru_cache
 import numpy as np
 from scipy.stats import chi2_contingency
-import statsmodels.api as sm
-from scipy.stats import norm
-import seaborn as sns
-import matplotlib.pyplot as plt
+from scipy.special import ndtri
+import pandas as pd
+
+# numba is optional, without it residuals are computed with plain numpy
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+def _resid_numpy(obs):
+    """Compute pearson and standardized residuals of a contingency table.
+    
+    Same formulas as `statsmodels.stats.contingency_tables.Table`.
+    """
+    row = obs.sum(1,keepdims=True)
+    col = obs.sum(0,keepdims=True)
+    n = obs.sum()
+    exp = row @ col / n
+    
+    pearson = (obs - exp) / np.sqrt(exp)
+    stdres = pearson / np.sqrt((1 - row/n) * (1 - col/n))
+    
+    return pearson,stdres
+
+if njit is not None:
+    @njit(cache=True,error_model='numpy')
+    def _resid_kernel(obs):
+        n = obs.sum()
+        row = obs.sum(1)
+        col = obs.sum(0)
+        pr = np.empty_like(obs)
+        sr = np.empty_like(obs)
+        for i in range(obs.shape[0]):
+            for j in range(obs.shape[1]):
+                e = row[i]*col[j]/n
+                d = obs[i,j]-e
+                s = math.sqrt(e)
+                pr[i,j] = d/s
+                sr[i,j] = d/(s*math.sqrt((1-row[i]/n)*(1-col[j]/n)))
+        return pr,sr
+else:
+    _resid_kernel = _resid_numpy
 
 class Chi2Independence():
     """Class for performing a Chi2 test of independence, additional post-hoc tests 
@@ -32,53 +72,123 @@ class Chi2Independence():
         :func:`scipy.stats.chi2_contigency`
     
     shift_zeros: bool, optional
-        This value is passed over to :func:`statsmodels.stats.contingency_tables.Table`
-        If True and any cell count is zero, add 0.5 to all values in the table.
-        See documentation of `statsmodels.stats.contingency_tables.Table`
+        If True, zero cells are set to 0.5 before computing the residuals
+        (same as `shift_zeros` of `statsmodels.stats.contingency_tables.Table`).
     
     """
+    # critical z-values by alpha, cached across all instances
+    @staticmethod
+    @lru_cache(maxsize=32)
+    def _zcrit(alpha):
+        """Return the upper critical z-value of a two-sided test.
+        
+        ndtri is the inverse of the standard normal cdf (same as scipy.stats.norm.ppf).
+        """
+        return float(ndtri(1-alpha/2))
+    
     def __init__(self,crosstab,correction=True,lambda_=None,shift_zeros=False):
         self.crosstab = crosstab
         self.correction = correction
         self.lambda_ = lambda_
         self.shift_zeros = shift_zeros
         
-    def chi2_ind(self):
+        # convert observed frequencies once (labels are still taken from self.crosstab)
+        self._obs = np.ascontiguousarray(self.crosstab.to_numpy(),dtype=np.float64)
+        
+    def chi2_ind(self,force=False):
         """Perform a Chi2 test of independence. This is a wrapper function around
         :func:`scipy.stats.chi2_contingency`. `Standardized` and `adjusted 
         standardized` residuals are added to the output of the Chi2 test.
+        
+        Parameters
+        ----------
+        force: bool (default=False)
+            If False, results of a previous call are returned without
+            recomputing them. Set to True to re-run the test, e.g. after
+            changing `crosstab`, `correction`, `lambda_` or `shift_zeros`.
+            Results of previous calls to 
+            :func:`~statplot.Chi2Independence.test_residuals()` are discarded.
                 
         Note
         ----
         For more information see https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.chi2_contingency.html
         """
+        if hasattr(self,'results') and not force:
+            return self.results
+        
+        if force:
+            # crosstab might have been reassigned and post-hoc results are stale
+            self._obs = np.ascontiguousarray(self.crosstab.to_numpy(),dtype=np.float64)
+            for attr in ('df_freq','_stdres_sig'):
+                if hasattr(self,attr):
+                    delattr(self,attr)
 
-        self.results_chi2_ = chi2_contingency(observed=self.crosstab,
+        self.results_chi2_ = chi2_contingency(observed=self._obs,
                                               correction=self.correction,
                                               lambda_=self.lambda_)
-        self._get_residuals()
+        self._get_residuals(force=force)
         self.results = self.results_chi2_ + (self._residuals,) + (self._stdres,)
         
         return self.results
         
-    def _get_residuals(self):
-        self._table = sm.stats.Table(self.crosstab,shift_zeros=self.shift_zeros)
-        self._residuals = self._table.resid_pearson
-        self._stdres = self._table.standardized_resids
+    def _get_residuals(self,force=False):
+        if hasattr(self,'_stdres') and not force:
+            return
+        
+        obs = self._obs
+        if self.shift_zeros:
+            # set zero cells to 0.5 (returns a new array, self._obs is untouched)
+            obs = np.where(obs == 0,0.5,obs)
+        
+        # uses the numba kernel if numba is installed, else plain numpy
+        pearson,stdres = _resid_kernel(obs)
+        
+        self._residuals = pd.DataFrame(pearson,index=self.crosstab.index,columns=self.crosstab.columns)
+        self._stdres = pd.DataFrame(stdres,index=self.crosstab.index,columns=self.crosstab.columns)
         
-    def _test_single_residual(self,residual,upper_z,lower_z):
-          if residual < lower_z or residual > upper_z:
-            return True
-          else:
-            return False
+    def _compute_significance(self,alpha=0.05,correction=None):
+        """Test adjusted residuals for significance and return a boolean
+        vector (in row-major order of the crosstable). The result is also
+        stored as `self._stdres_sig`.
+        """
+        if not hasattr(self,'results'):
+            self.chi2_ind()
+        
+        # convert stdres crosstable to one-dimensional array
+        stdres_array = np.asarray(self._stdres.values).ravel()
+        
+        if not 0 < alpha < 1:
+            raise ValueError("alpha must be between 0 and 1")
+        
+        # correct for multiple comparisons
+        if correction == 'bonferroni':
+            alpha = alpha / stdres_array.size
+        elif correction is not None:
+            raise ValueError("correction must be None or 'bonferroni'")
+        
+        # get critical upper and lower z-value
+        upper_z = self._zcrit(alpha)
+        lower_z = -upper_z
         
-    # TO-DO: When testing residuals for significance there should be an option to correct
-    # for multiple comparisons.
-    def test_residuals(self):
+        # test every residual for significance (return boolean)
+        self._stdres_sig = (stdres_array < lower_z) | (stdres_array > upper_z)
+        
+        return self._stdres_sig
+    
+    def test_residuals(self,alpha=0.05,correction=None):
         """Test adjusted residuals for significance.
         
         This method performs post-hoc tests on the adjusted residuals.
-        `p-value` correction is not applied.
+        
+        Parameters
+        ----------
+        alpha: float (default=0.05)
+            Significance level of the two-sided test of each residual.
+        
+        correction: str (default=None)
+            Correction for multiple comparisons. If `None`, no correction is
+            applied. If 'bonferroni', `alpha` is divided by the number of
+            cells in the crosstable.
         
         Returns
         -------
@@ -92,29 +202,30 @@ class Chi2Independence():
         if this method has not been called by the user.
         
         """
-        if not hasattr(self,'results'):
-            self.chi2_ind()
-        
-        # convert stdres crosstable to one-dimensional array
-        stdres_array = self._stdres.values.flatten()
+        stdres_sig = self._compute_significance(alpha=alpha,correction=correction)
         
-        # check for significant local differences
-        alpha = 0.05
+        # convert crosstab to dataframe (append significance vector)
+        # (row-major order, equivalent to crosstab.stack().reset_index())
+        rows = np.asarray(self.crosstab.index)
+        cols = np.asarray(self.crosstab.columns)
+        n_rows,n_cols = len(rows),len(cols)
         
-        # get critical upper and lower z-value
-        upper_z =  norm.ppf(1-alpha/2)
-        lower_z = norm.ppf(alpha/2)
+        columns = [(self.crosstab.index.name or 'level_0',np.repeat(rows,n_cols)),
+                   (self.crosstab.columns.name or 'level_1',np.tile(cols,n_rows)),
+                   ('Frequency',self.crosstab.values.ravel()),
+                   ('sig',stdres_sig)]
         
-        # test every residual for significance (return boolean)
-        stdres_sig = np.array([self._test_single_residual(residual,upper_z,lower_z) for residual in np.nditer(stdres_array)])
+        # a dict would silently drop columns with the same name
+        names = [name for name,_ in columns]
+        for i,name in enumerate(names):
+            if name in names[:i]:
+                raise ValueError(f"cannot insert {name}, already exists")
         
-        # convert crosstab to dataframe (append significance vector)
-        self.df_freq = self.crosstab.stack().reset_index().rename(columns={0:'Frequency'})
-        self.df_freq['sig'] = stdres_sig
+        self.df_freq = pd.DataFrame(dict(columns))
         
         return self.df_freq
     
-    def plot(self,x,hue,title=None,dst_dir=None,**kwargs):
+    def plot(self,x,hue,title=None,dst_dir=None,ax=None,**kwargs):
         """Plot results of Chi2 test of independence as a barplot.
         
         Parameters
@@ -123,38 +234,93 @@ class Chi2Independence():
             Name of the variable which should be put on the x-axis.
             
         hue: str
-            Name of the variable which is responsible for hueing.
+            Name of the variable which is responsible for hueing. Must be
+            the other variable of the crosstable than `x`.
         
         dst_dir: str (default=None)
             A string providing the path to the destination directory
             where the barplot should be saved. If `None` plot will not be saved.
         
+        ax: matplotlib.axes.Axes (default=None)
+            Axes object to draw the plot onto. If `None` the current axes
+            are used.
+        
         kwargs: key, value mappings
-            Other keyword arguments are passed through to seaborn.barplot
+            Other keyword arguments are passed through to matplotlib.axes.Axes.bar,
+            except `width` which sets the total width of each group of bars
+            (default=0.8).
+            `label` is not allowed because the bars are labeled with the 
+            categories of `hue`.
         
         Note
         ----
-        This method automatically calls :func:`~statplot.Chi2Independence.test_residuals()` 
-        if this method has not been called by the user.
+        This method automatically tests the residuals for significance 
+        (with default settings) if :func:`~statplot.Chi2Independence.test_residuals()`
+        has not been called by the user.
             
         """
-        if not hasattr(self,'df_freq'):
-            self.test_residuals()
+        # import here so that users who only need the statistics don't pay
+        # the import cost of matplotlib
+        import matplotlib.pyplot as plt
+        
+        # x and hue must name the two different variables of the crosstab
+        row_name = self.crosstab.index.name or 'level_0'
+        col_name = self.crosstab.columns.name or 'level_1'
+        
+        if x == hue or x not in (row_name,col_name) or hue not in (row_name,col_name):
+            raise ValueError(f"x and hue must be two different variables out of '{row_name}' and '{col_name}'")
+        
+        if 'label' in kwargs:
+            raise ValueError("'label' cannot be passed, bars are labeled with the categories of hue")
         
-        barplot = sns.barplot(data=self.df_freq,x=x,y='Frequency',hue=hue,**kwargs)
+        if not hasattr(self,'_stdres_sig'):
+            self._compute_significance()
+        
+        # bring frequencies and significance vector into shape
+        # (rows = categories on the x-axis, columns = hue categories)
+        freq = self.crosstab
+        stdres_sig_2d = self._stdres_sig.reshape(self.crosstab.shape)
+        
+        if hue == row_name:
+            freq = freq.T
+            stdres_sig_2d = stdres_sig_2d.T
+        
+        # grouped barplot, one call to ax.bar per hue category
+        # (width is the total width of a group, as in seaborn.barplot)
+        n_x,n_hue = freq.shape
+        width = kwargs.pop('width',0.8)
+        bar_width = width / n_hue
+        xs = np.arange(n_x)
+        ax = ax or plt.gca()
+        
+        for i,hue_level in enumerate(freq.columns):
+            ax.bar(xs - width/2 + (i + 0.5) * bar_width,freq.iloc[:,i].to_numpy(),bar_width,label=str(hue_level),**kwargs)
+        
+        ax.set_xticks(xs)
+        ax.set_xticklabels(freq.index)
+        ax.set_xlabel(x)
+        ax.set_ylabel('Frequency')
+        ax.legend(title=hue)
         
         if title:
-            barplot.set_title(title)
+            ax.set_title(title)
         
         # add significance asterisks
-        stdres_sig_sorted = self.df_freq.sort_values(hue)['sig']
+        # (patches are ordered by hue, same as the transposed significance matrix)
+        stdres_sig_sorted = stdres_sig_2d.T.ravel()
+        
+        # extract bar geometry in one pass, then do the arithmetic in numpy
+        patches = ax.patches[-stdres_sig_sorted.size:]
+        geom = np.array([(p.get_x(),p.get_width(),p.get_height()) for p in patches],dtype=np.float64).reshape(-1,3)
+        x_center = geom[:,0] + geom[:,1]*0.5
+        heights = geom[:,2]
+        mask = np.asarray(stdres_sig_sorted,dtype=bool)
         
-        for p,sig in zip(barplot.patches,stdres_sig_sorted):
-            if sig == True:
-                barplot.text(p.get_x()+p.get_width()/2.,p.get_height(),'*',ha='center')
+        for x_pos,y_pos in zip(x_center[mask],heights[mask]):
+            ax.text(x_pos,y_pos,'*',ha='center')
                 
         if dst_dir is not None:
-            plt.savefig(dst_dir,dpi=600)
+            ax.figure.savefig(dst_dir,dpi=600)
             
 if __name__ == '__main__':
     pass
\ No newline at end of file